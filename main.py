@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import calendar
+import collections
 import configparser
 import datetime
 import io
@@ -8,10 +10,12 @@ import re
 import csv
 import signal
 import sqlite3
+import tempfile
 
-from functools import wraps
+from functools import lru_cache, wraps
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ChatAction
+from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
                           CallbackQueryHandler )
 
@@ -27,7 +31,8 @@ config.read('config.ini')
 try:
     separator_date = int(config['DEFAULT']['separator_date'])
     updater = Updater(token=config['DEFAULT']['token'])
-    admin_list = [int(x) for x in config['DEFAULT']['admin_list'].split(',')]
+    admin_set = frozenset(int(x) for x in
+                          config['DEFAULT']['admin_list'].split(','))
     print("Configuration initialized!")
 except KeyError:
     print("Make sure you copied sample config.ini and replaced TOKEN in it")
@@ -44,34 +49,115 @@ db_path = os.path.join(BASE_DIR, "data.db")
 
 # {{{ Generic functions
 
-
-def parse_sms(text: str) -> dict:
-    """
-    Parses SMS using re, example of a valid SMS (only sberbank is supported ATM):
-    VISA1234 21.12.16 22:12
-    зачисление зарплаты 12345.57р
-    Баланс: 16063.28р
-    """
-
-    sms_data = {}
-    sms_pattern = re.compile(r'''
+# compiled once at import, parse_sms is called for every line of CSV import
+SMS_PATTERN = re.compile(r'''
     # matching anywhere in string
     ([A-Z]{4}\d{4})                        # matching card
     \ +                                    # separator is one space or more
-    (\d{2}\.\d{2}\.\d{2}\ \d{2}:\d{2})     # matching date and time
+    (\d{2})\.(\d{2})\.(\d{2})              # matching date as DD.MM.YY
+    \ (\d{2}):(\d{2})                      # matching time as HH:MM
     \D*                       # optional separator is any number of non digits
     (?:зарплаты|отпускных)    # non-capturing alternation group
     \D*                       # optional separator is any number of non digits
     (\d+\.*\d*)                            # matching amount
     ''', re.VERBOSE)
+CARD_PATTERN = re.compile(r'''
+    ^                          # matching from the start of the string
+    [A-Z]{4}\d{4}              # matching card
+    $                          # end of the string follows immediately
+    ''', re.VERBOSE)
+
+# immutable result of parse_sms, safe to share out of the lru_cache
+Sms = collections.namedtuple('Sms', 'card datetime amount')
+
+
+@lru_cache(maxsize=8192)
+def parse_sms(text: str) -> Sms:
+    """
+    Parses SMS using re, example of a valid SMS (only sberbank is supported ATM):
+    VISA1234 21.12.16 22:12
+    зачисление зарплаты 12345.57р
+    Баланс: 16063.28р
+    Returns None if text is not a valid SMS. Results are cached, re-imported
+    CSV lines are not parsed twice.
+    """
+
+    # cheap substring check, most non-matching lines never reach the regex
+    if 'зарплаты' not in text and 'отпускных' not in text:
+        return None
+    match = SMS_PATTERN.search(text)
+    if match is None:
+        return None
+
+    card, day, month, year, hour, minute, amount = match.groups()
+    # date parts come captured separately, much cheaper than strptime
+    return Sms(card,
+               datetime.datetime(2000 + int(year), int(month), int(day),
+                                 int(hour), int(minute)),
+               float(amount))
+
+
+@lru_cache(maxsize=64)
+def month_window(year: int, month: int, sep: int) -> tuple:
+    """
+    Returns (start, end) datetimes of the wage period that ends on sep day
+    of the given month, month may fall out of 1..12 and wraps into
+    the adjacent year
+    """
+    start_year, start_month = divmod(year * 12 + month - 2, 12)
+    end_year, end_month = divmod(year * 12 + month - 1, 12)
+    return (datetime.datetime(start_year, start_month + 1, sep),
+            datetime.datetime(end_year, end_month + 1, sep))
+
+
+def closed_window(dt: datetime.datetime) -> tuple:
+    """
+    Returns (start, end) of the latest wage period already closed by dt
+    """
+    month = dt.month if dt.day > separator_date else dt.month - 1
+    return month_window(dt.year, month, separator_date)
 
-    parsed_sms = sms_pattern.search(text).groups()
-    sms_data['card'] = parsed_sms[0]
-    sms_data['datetime'] = datetime.datetime.strptime(parsed_sms[1],
-                                                      "%d.%m.%y %H:%M")
-    sms_data['amount'] = float(parsed_sms[2])
 
-    return sms_data
+def is_month(text: str) -> bool:
+    try:
+        return 0 < int(text) < 13
+    except ValueError:
+        return False
+
+
+def is_year(text: str) -> bool:
+    try:
+        return 1999 < int(text) < 2051
+    except ValueError:
+        return False
+
+
+def period_window(args: list, now: datetime.datetime) -> tuple:
+    """
+    Resolves /wage arguments (MM YYYY, MM, YYYY or nothing for the last
+    month) into (start, end) datetimes, returns None on invalid input
+    """
+    if len(args) == 0:
+        return closed_window(now)
+    if len(args) == 2 and is_month(args[0]) and is_year(args[1]):
+        return month_window(int(args[1]), int(args[0]), separator_date)
+    if len(args) == 1 and is_month(args[0]):
+        return month_window(now.year, int(args[0]), separator_date)
+    if len(args) == 1 and is_year(args[0]):
+        # whole year is a span from the start of January's period
+        # to the end of December's
+        year = int(args[0])
+        return (month_window(year, 1, separator_date)[0],
+                month_window(year, 12, separator_date)[1])
+    return None
+
+
+def to_epoch(dt: datetime.datetime) -> int:
+    """
+    Converts naive datetime into integer seconds as stored in date_time
+    column, treated as UTC to match SQLite's unixepoch modifier
+    """
+    return calendar.timegm(dt.timetuple())
 
 
 def valid_card(text: str) -> bool:
@@ -79,64 +165,116 @@ def valid_card(text: str) -> bool:
     Parses card number, returns True if proper format
     """
 
-    card_pattern = '''
-    ^                          # matching from the start of the string
-    [A-Z]{4}\d{4}              # matching card
-    $                          # end of the string follows immediately
-    '''
-    return True if re.search(card_pattern, text, re.VERBOSE) else False
+    return CARD_PATTERN.match(text) is not None
 
 # }}}
 
 # {{{ SQLite retrieval functions
 
+# chat_id -> frozenset of ignored cards, checked on every incoming SMS
+ignored_cards_cache = {}
+# bumped whenever datatable_init has new DDL or migrations to run
+SCHEMA_VERSION = 2
+# statements used on every SMS, kept identical so sqlite3 reuses the
+# prepared statement from its cache
+INSERT_SQL = "INSERT OR IGNORE INTO data VALUES (?, ?, ?, ?, ?)"
+# date_time is stored as epoch seconds, rendered back as text on output
+DATA_COLUMNS = "chat_id, name, card, datetime(date_time, 'unixepoch'), amount"
+# half-open (start, end] period, so a boundary timestamp counts only once
+WAGE_SQL = "SELECT SUM(amount) FROM data \
+            WHERE chat_id=? AND date_time > ? AND date_time <= ?"
+
+
+def db_connect(path: str) -> sqlite3.Connection:
+    """
+    Opens SQLite connection, WAL with relaxed sync avoids a full fsync on
+    every commit and lets readers proceed while a writer commits
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.executescript('''PRAGMA journal_mode=WAL;
+                                 PRAGMA synchronous=NORMAL;
+                                 PRAGMA temp_store=MEMORY;
+                                 PRAGMA cache_size=-20000;
+                                 PRAGMA mmap_size=268435456;''')
+    return connection
+
 
 def datatable_init():
     """
-    Creates if necessary data.db SQLite database
+    Creates if necessary data.db SQLite database, DDL only runs when
+    user_version shows the schema is older than SCHEMA_VERSION
     """
-    cursor.execute('''CREATE TABLE IF NOT EXISTS data (
+    if db.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return None
+
+    db.execute('''CREATE TABLE IF NOT EXISTS data (
                chat_id INTEGER,
                name TEXT,
                card TEXT,
-               date_time DATETIME,
+               date_time INTEGER,
                amount REAL,
                UNIQUE(chat_id, name, card, date_time, amount)
                )''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS ignored_cards (
+    # databases created before date_time became INTEGER keep text dates
+    db.execute("""UPDATE OR IGNORE data
+               SET date_time = CAST(strftime('%s', date_time) AS INTEGER)
+               WHERE typeof(date_time) = 'text'""")
+    # covering index, wage_calc sums amount without touching the table
+    db.execute('''CREATE INDEX IF NOT EXISTS idx_chat_date
+               ON data(chat_id, date_time, amount)''')
+    db.execute('''CREATE INDEX IF NOT EXISTS idx_chat_card
+               ON data(chat_id, card)''')
+    # chatid_from_name resolves /wagedb and /modnotify usernames
+    db.execute('''CREATE INDEX IF NOT EXISTS idx_name
+               ON data(name, chat_id)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS ignored_cards (
                chat_id INTEGER,
                ignore_card TEXT,
                UNIQUE(chat_id, ignore_card)
                )''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS notified (
+    db.execute('''CREATE TABLE IF NOT EXISTS notified (
                chat_id INTEGER,
                notify INTEGER,
                UNIQUE(chat_id, notify)
                )''')
+    # gathers statistics for newly created indexes so the planner uses them,
+    # only runs on schema upgrade so a full ANALYZE is affordable
+    db.execute("ANALYZE")
+    db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
     db.commit()
 
 
-def insert_transaction(chat_id: int, username: str, sms_data: dict):
+def insert_transaction(chat_id: int, username: str, sms_data: Sms) -> bool:
     """
-    Takes in chat_id of the convo and parsed sms dictionary, writes data into DB
+    Takes in chat_id of the convo and a parsed Sms, writes data into DB
+    Returns False if this exact transaction was already there
     """
     with db:
-        cursor.execute("INSERT OR IGNORE INTO data \
-            VALUES (:id, :name, :card, :datetime, :amount)",
-            {'id': chat_id, 'name': username, 'card': sms_data['card'],
-             'datetime': sms_data['datetime'], 'amount': sms_data['amount']})
+        cursor = db.execute(INSERT_SQL, (chat_id, username, sms_data.card,
+                                         to_epoch(sms_data.datetime),
+                                         sms_data.amount))
+        added = cursor.rowcount > 0
+    if added:
+        clear_name_caches()
+    return added
 
 
-def new_transaction(chat_id: int, username: str, sms_data: dict):
+def insert_transactions(chat_id: int, username: str, sms_iter) -> int:
     """
-    Checks whether this exact transaction is already in the database
+    Bulk version of insert_transaction, writes all parsed sms in one transaction
+    Accepts any iterable of parsed sms, returns number of rows actually added
     """
-    cursor.execute("SELECT COUNT(*) FROM data \
-            WHERE chat_id=:id AND name=:name AND card=:card\
-            AND date_time=:datetime AND amount=:amount",
-        {'id': chat_id, 'name': username, 'card': sms_data['card'],
-         'datetime': sms_data['datetime'], 'amount': sms_data['amount']})
-    return False if cursor.fetchone()[0] > 0 else True
+    with db:
+        cursor = db.executemany(INSERT_SQL,
+            ((chat_id, username, sms_data.card,
+              to_epoch(sms_data.datetime), sms_data.amount)
+             for sms_data in sms_iter))
+        added = cursor.rowcount
+    # refresh planner statistics after a bulk load
+    db.execute("PRAGMA optimize")
+    if added:
+        clear_name_caches()
+    return added
 
 
 def insert_ignored_card(chat_id: int, card: str):
@@ -144,106 +282,153 @@ def insert_ignored_card(chat_id: int, card: str):
     Takes in chat_id of the convo and a card to ignore, keeps the data in DB
     """
     with db:
-        cursor.execute("INSERT OR IGNORE INTO ignored_cards VALUES (:id, :card)",
-                       {'id': chat_id, 'card': card})
+        db.execute("INSERT OR IGNORE INTO ignored_cards VALUES (?, ?)",
+                   (chat_id, card))
+    ignored_cards_cache.pop(chat_id, None)
 
 
 def remove_ignored_card(chat_id: int, card: str):
     with db:
-        cursor.execute("DELETE FROM ignored_cards \
-                        WHERE chat_id=:id and ignore_card=:card",
-                       {'id': chat_id, 'card': card})
+        db.execute("DELETE FROM ignored_cards \
+                    WHERE chat_id=? and ignore_card=?", (chat_id, card))
+    ignored_cards_cache.pop(chat_id, None)
 
 
 def insert_notify(chat_id: int, notified: int):
     with db:
-        cursor.execute("INSERT OR IGNORE INTO notified VALUES (:id, :notified)",
-                       {'id': chat_id, 'notified': notified})
+        db.execute("INSERT OR IGNORE INTO notified VALUES (?, ?)",
+                   (chat_id, notified))
 
 
-def show_ignored_cards(chat_id: int) -> tuple:
-    cursor.execute("SELECT ignore_card FROM ignored_cards WHERE chat_id=?",
-                   (chat_id,))
-    return sum(cursor.fetchall(), ())
+def show_ignored_cards(chat_id: int) -> frozenset:
+    """
+    Returns ignored cards of a user, cached until the user changes the list
+    """
+    if chat_id not in ignored_cards_cache:
+        cursor = db.execute("SELECT ignore_card FROM ignored_cards \
+                            WHERE chat_id=?", (chat_id,))
+        ignored_cards_cache[chat_id] = frozenset(row[0]
+                                                 for row in cursor.fetchall())
+    return ignored_cards_cache[chat_id]
 
 
 def remove_notify(chat_id: int, notified: int):
     with db:
-        cursor.execute("DELETE FROM notified WHERE chat_id=:id and notify=:card",
-                       {'id': chat_id, 'notified': notified})
+        db.execute("DELETE FROM notified WHERE chat_id=? and notify=?",
+                       (chat_id, notified))
+
 
+def to_notify(chat_id: int) -> frozenset:
+    cursor = db.execute("SELECT notify FROM notified WHERE chat_id=?", (chat_id,))
+    return frozenset(row[0] for row in cursor.fetchall())
 
-def to_notify(chat_id: int) -> tuple:
-    cursor.execute("SELECT notify FROM notified WHERE chat_id=?", (chat_id,))
-    return sum(cursor.fetchall(), ())
+
+def fetch_batches(query: str, params: tuple = (), batch: int = 1000):
+    """
+    Yields rows of a query fetched batch by batch, so memory stays bounded.
+    Uses its own cursor, other queries may run while rows are consumed
+    """
+    rows_cursor = db.execute(query, params)
+    while True:
+        rows = rows_cursor.fetchmany(batch)
+        if not rows:
+            return
+        yield from rows
 
 
-def table_data() -> list:
+def table_data():
     """
-    Returns ALL available data, list of tuples
+    Returns ALL available data, iterator of tuples
     """
-    cursor.execute("SELECT * FROM data")
-    return cursor.fetchall()
+    return fetch_batches(f"SELECT {DATA_COLUMNS} FROM data")
 
 
-def user_data(chat_id: str) -> list:
+def fetch_user_data(chat_id: str):
     """
-    Returns user data, list of tuples
+    Returns user data, iterator of tuples
     """
-    cursor.execute("SELECT * FROM data WHERE chat_id=?", (chat_id,))
-    return cursor.fetchall()
+    return fetch_batches(f"SELECT {DATA_COLUMNS} FROM data WHERE chat_id=?",
+                         (chat_id,))
 
 
 def new_card(chat_id: str, card: str) -> bool:
     """
     Checks whether this card type and number already in DB for this user
     """
-    cursor.execute("SELECT COUNT(*) FROM data WHERE chat_id=:id AND card=:card",
-        {'id': chat_id, 'card': card})
-    return False if cursor.fetchone()[0] > 0 else True
+    cursor = db.execute("SELECT EXISTS(SELECT 1 FROM data \
+                    WHERE chat_id=? AND card=? LIMIT 1)", (chat_id, card))
+    return not cursor.fetchone()[0]
 
 
 def user_records(chat_id: str) -> list:
     """
     Returns number of relevant user records
     """
-    cursor.execute("SELECT COUNT(*) FROM data WHERE chat_id=?", (chat_id,))
+    cursor = db.execute("SELECT COUNT(*) FROM data WHERE chat_id=?", (chat_id,))
     return cursor.fetchone()[0]
 
 
 def wage_calc(chat_id: str, start_date, end_date) -> list:
-    cursor.execute('''SELECT SUM(amount)
-                      FROM data WHERE chat_id=:id
-                      AND date_time BETWEEN :sd and :ed''',
-                   {'id': chat_id, 'sd': start_date, 'ed': end_date})
+    cursor = db.execute(WAGE_SQL, (chat_id, to_epoch(start_date),
+                                   to_epoch(end_date)))
     sum_ = cursor.fetchone()[0]
     return sum_ if sum_ else 0
 
 
+def monthly_wages(chat_id: int, year: int) -> list:
+    """
+    Returns wage for each month of a year in a single query, a month's
+    wage being the sum over its month_window
+    """
+    start_date = month_window(year, 1, separator_date)[0]
+    end_date = month_window(year, 12, separator_date)[1]
+    # timestamps past sep day midnight count towards the next month
+    cursor = db.execute('''
+        SELECT strftime('%m', date_time, 'unixepoch', 'start of month',
+                        CASE WHEN date_time > CAST(strftime('%s', date_time,
+                                  'unixepoch', 'start of month', ?) AS INTEGER)
+                        THEN '+1 month' ELSE '+0 months' END) AS month,
+               SUM(amount)
+        FROM data WHERE chat_id=? AND date_time > ? AND date_time <= ?
+        GROUP BY month''',
+        (f'+{separator_date - 1} days', chat_id,
+         to_epoch(start_date), to_epoch(end_date)))
+    sums = {int(month): sum_ for month, sum_ in cursor.fetchall()}
+    return [sums.get(month, 0) for month in range(1, 13)]
+
+
 def purge_all():
     with db:
-        cursor.execute("DELETE FROM data")
+        db.execute("DELETE FROM data")
+    clear_name_caches()
 
 
 def purge_user(user: int):
     with db:
-        cursor.execute("DELETE FROM data WHERE chat_id=?", (user,))
+        db.execute("DELETE FROM data WHERE chat_id=?", (user,))
+    clear_name_caches()
+
 
+def clear_name_caches():
+    """
+    Name <-> chat_id lookups are cached, drop them whenever data rows change
+    """
+    chatid_from_name.cache_clear()
+    name_from_chatid.cache_clear()
 
+
+@lru_cache(maxsize=1024)
 def chatid_from_name(user: str) -> int:
-    cursor.execute("SELECT chat_id FROM data WHERE name=? LIMIT 1", (user,))
-    try:
-        return cursor.fetchone()[0]
-    except IndexError:
-        return None
+    cursor = db.execute("SELECT chat_id FROM data WHERE name=? LIMIT 1", (user,))
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
 
 
+@lru_cache(maxsize=1024)
 def name_from_chatid(chatid: int) -> str:
-    cursor.execute("SELECT name FROM data WHERE chat_id=? LIMIT 1", (chatid,))
-    try:
-        return cursor.fetchone()[0]
-    except IndexError:
-        return None
+    cursor = db.execute("SELECT name FROM data WHERE chat_id=? LIMIT 1", (chatid,))
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
 
 
 # }}}
@@ -255,7 +440,7 @@ def restricted(func):
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         user_id = update.effective_user.id
-        if user_id not in admin_list:
+        if user_id not in admin_set:
             bot.send_message(chat_id=update.message.chat_id,
                              text="You don't have access to this command.")
             return None
@@ -265,100 +450,97 @@ def restricted(func):
 
 def start(bot, update):
     bot.send_message(chat_id=update.message.chat_id,
-        text='This bot parses and stores info about your monthly earnings!')
-    bot.send_message(chat_id=update.message.chat_id,
-        text='Please, send SMS from the bank')
+        text='This bot parses and stores info about your monthly earnings!\n'
+             'Please, send SMS from the bank')
 
 
-def sms(bot, update):
+def add_sms(bot, update):
     """
     On receiving SMS, tries to parse it and add to DB, otherwise reprompts user.
     Also shows accumulative wage in a month that SMS was from.
     If to_notify is not empty, sends an info message to all users in a notify
     list.
     """
-    try:
-        sms_p = parse_sms(update.message.text)
-    except AttributeError:
+    sms_p = parse_sms(update.message.text)
+    if sms_p is None:
         bot.send_message(chat_id=update.message.chat_id,
                          text='Unable to parse. Please, send valid SMS!')
         return None
 
-    if sms_p['card'] in show_ignored_cards(update.message.chat_id):
+    if sms_p.card in show_ignored_cards(update.message.chat_id):
         bot.send_message(chat_id=update.message.chat_id,
             text='You are trying to add a transaction from ignored card number.')
+        return None
 
-    if not new_transaction(update.message.chat_id,
-                           update.message.from_user['username'], sms_p):
+    # UNIQUE constraint does the duplicate check within the same INSERT
+    if not insert_transaction(update.message.chat_id,
+                              update.message.from_user['username'], sms_p):
         bot.send_message(chat_id=update.message.chat_id,
             text='Record of this transaction already exists.')
         return None
 
-    insert_transaction(update.message.chat_id,
-                       update.message.from_user['username'], sms_p)
+    now = datetime.datetime.now()
+    today = sms_p.datetime.date() == now.date()
+    base = now if today else sms_p.datetime
+    start_date, end_date = closed_window(base)
+    wage = wage_calc(update.message.chat_id, start_date, end_date)
+    text = ("Your last month's wage is {:.2f} so far" if today else
+            "Your wage in that month is {:.2f} so far")
     bot.send_message(chat_id=update.message.chat_id,
-                     text='Transaction added successfully!')
+        text='Transaction added successfully!\n' + text.format(wage))
 
+    notification = '{} just added the following message: \n {}'.format(
+        update.message.from_user['username'], update.message.text)
     for recipient in to_notify(update.message.chat_id):
-        bot.send_message(chat_id=recipient,
-            text='{} just added the following message: \n {}'.
-            format(update.message.from_user['username'], update.message.text))
-
-    if sms_p['datetime'].date() == datetime.datetime.now().date():
-        now = datetime.datetime.now()
-        month = now.month if now.day > separator_date else now.month - 1
-        start_date = datetime.datetime(now.year, month-1, separator_date)
-        end_date = datetime.datetime(now.year, month, separator_date)
-        wage = wage_calc(update.message.chat_id, start_date, end_date)
-        bot.send_message(chat_id=update.message.chat_id,
-                text=f"Your last month's wage is {wage:.2f} so far")
-    else:
-        now = sms_p['datetime']
-        month = now.month if now.day > separator_date else now.month - 1
-        start_date = datetime.datetime(now.year, month-1, separator_date)
-        end_date = datetime.datetime(now.year, month, separator_date)
-        wage = wage_calc(update.message.chat_id, start_date, end_date)
-        bot.send_message(chat_id=update.message.chat_id,
-                text=f"Your wage in that month is {wage:.2f} so far")
+        bot.send_message(chat_id=recipient, text=notification)
 
 
 def csv_parse(bot, update):
-    if update.message.document.file_name[-4:] != '.csv':
-        bot.send_message(chat_id=update.message.chat_id,
+    chat_id = update.message.chat_id
+    if not update.message.document.file_name.lower().endswith('.csv'):
+        bot.send_message(chat_id=chat_id,
                          text="Only CSV is allowed!")
         return None
     else:
-        bot.send_message(chat_id=update.message.chat_id,
+        bot.send_message(chat_id=chat_id,
                          text="CSV file found, commencing download")
 
-    # downloading CSV file into memory as a StringIO
+    # downloading CSV file into memory, csv.reader decodes it on the fly
     csvf = bot.getFile(update.message.document.file_id)
-    csv_file_bin = io.BytesIO()
-    csvf.download(out=csv_file_bin)
-    csv_file_bin.seek(0)
+    csv_file_bin = io.BytesIO(csvf.download_as_bytearray())
 
-    bot.send_message(chat_id=update.message.chat_id,
+    bot.send_message(chat_id=chat_id,
                      text="Download complete, commencing parsing")
-    bot.send_chat_action(chat_id=update.message.chat_id,
+    bot.send_chat_action(chat_id=chat_id,
                          action=ChatAction.TYPING)
 
     i, j, k = 0, 0, 0
-    for line in csv_file_bin:
-        try:
-            parsed = parse_sms(line.decode('UTF-8').split(',')[-1])
-            if parsed['card'] not in show_ignored_cards(update.message.chat_id):
-                insert_transaction(update.message.chat_id,
-                                   update.message.from_user['username'], parsed)
-            else:
-                k += 1
-            i += 1
-        except AttributeError:
-            pass
-        finally:
+    # fetched once for the whole file, not per row
+    ignored = show_ignored_cards(chat_id)
+    reader = csv.reader(io.TextIOWrapper(csv_file_bin, encoding='UTF-8',
+                                         newline=''))
+
+    def records():
+        """ Streams parsed, not ignored records straight into executemany """
+        nonlocal i, j, k
+        for row in reader:
             j += 1
+            parsed = parse_sms(row[-1]) if row else None
+            if parsed is None:
+                continue
+            i += 1
+            if parsed.card in ignored:
+                k += 1
+                continue
+            yield parsed
 
-    bot.send_message(chat_id=update.message.chat_id,
-        text=f"{j} lines total, {i} of them were parsed and added, {k} were ignored.")
+    # single transaction for the whole file instead of a commit per row
+    added = insert_transactions(chat_id, update.message.from_user['username'],
+                                records())
+
+    bot.send_message(chat_id=chat_id,
+                     text=f"{j} rows total, {i} of them were parsed, "
+                          f"{k} were ignored, {added} new records added.")
 
 
 def form_csv(bot, update):
@@ -366,24 +548,21 @@ def form_csv(bot, update):
                      text="Preparing CSV file...")
     bot.send_chat_action(chat_id=update.message.chat_id,
                          action=ChatAction.TYPING)
-    csv_file = io.StringIO()
+    # rows are encoded straight into the bytes buffer, no intermediate copies
     csvb_file = io.BytesIO()
-    csv_writer = csv.writer(csv_file)
-    for row in user_data(update.message.chat_id):
-        csv_writer.writerow(row)
+    csv_file = io.TextIOWrapper(csvb_file, encoding='UTF-8', newline='',
+                                write_through=True)
+    csv.writer(csv_file).writerows(fetch_user_data(update.message.chat_id))
+    # detaching keeps csvb_file open once the wrapper is gone
+    csv_file.detach()
+    csvb_file.seek(0)
 
     bot.send_message(chat_id=update.message.chat_id,
                      text="Data gathered...")
 
-    csvb_file.write(csv_file.getvalue().encode())
-
-    bot.send_message(chat_id=update.message.chat_id,
-                     text="Data encoded...")
-    csvb_file.seek(0)
-
     bot.send_document(chat_id=update.message.chat_id,
-        filename=f"{datetime.datetime.now():%Y_%m_%d_%H.%M}-\
-                   {update.message.from_user['username']}.csv",
+        filename=f"{datetime.datetime.now():%Y_%m_%d_%H.%M}-"
+                 f"{update.message.from_user['username']}.csv",
         document=csvb_file)
 
 
@@ -408,8 +587,18 @@ def purgeuser(bot, update):
 
 @restricted
 def dump_db(bot, update):
-    bot.send_document(chat_id=update.message.chat_id,
-                      document=open(db_path, 'rb'))
+    """
+    Sends a consistent snapshot made with SQLite backup API, reading
+    db_path directly could catch it mid-write and miss pages kept in WAL
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, os.path.basename(db_path))
+        snapshot = sqlite3.connect(snapshot_path)
+        db.backup(snapshot)
+        snapshot.close()
+        with open(snapshot_path, 'rb') as snapshot_file:
+            bot.send_document(chat_id=update.message.chat_id,
+                              document=snapshot_file)
 
 
 def wage_template(bot, update, args, user=0):
@@ -420,81 +609,20 @@ def wage_template(bot, update, args, user=0):
     if user == 0:
         user = update.message.chat_id
 
-    def is_month(text: str) -> bool:
-        try:
-            return 0 < int(text) < 32
-        except ValueError:
-            return False
-
-    def is_year(text: str) -> bool:
-        try:
-            return 1999 < int(text) < 2051
-        except ValueError:
-            return False
-
-    # testing for proper input
-    if len(args) == 2 and is_month(args[0]) and is_year(args[1]):
-        pass
-    elif len(args) == 1 and (is_month(args[0]) or is_year(args[0])):
-        pass
-    elif len(args) != 0:
+    window = period_window(args, datetime.datetime.now())
+    if window is None:
         bot.send_message(chat_id=update.message.chat_id,
                 text="Incorrect format. Should be MM YYYY, both are optional.\
                       Example: 07 2017")
         return None
 
-    if len(args) == 2:
-        month = int(args[0])
-        year = int(args[1])
-        if month == 12:
-            start_date = datetime.datetime(year, month, separator_date)
-            end_date = datetime.datetime(year+1, 1, separator_date)
-        else:
-            start_date = datetime.datetime(year, month-1, separator_date)
-            end_date = datetime.datetime(year, month, separator_date)
-    elif len(args) == 1:
-        if is_month(args[0]):
-            month = int(args[0])
-            year = datetime.datetime.now().year
-            if month == 12:
-                start_date = datetime.datetime(year, month, separator_date)
-                end_date = datetime.datetime(year+1, 1, separator_date)
-            else:
-                start_date = datetime.datetime(year, month-1, separator_date)
-                end_date = datetime.datetime(year, month, separator_date)
-
-        elif is_year(args[0]):
-            # wage by month
-            acc = []
-            year = int(args[0])
-            for month in range(1,12):
-                start_date = datetime.datetime(year, month, separator_date)
-                end_date = datetime.datetime(year, month+1, separator_date)
-                acc.append(wage_calc(user, start_date, end_date))
-            start_date = datetime.datetime(year, 12, separator_date)
-            end_date = datetime.datetime(year+1, 1, separator_date)
-            acc.append(wage_calc(user, start_date, end_date))
-            acc = [int(x) for x in acc]
-            bot.send_message(chat_id=update.message.chat_id, text=acc)
-            # Total wage
-            start_date = datetime.datetime(year, 1, separator_date)
-            end_date = datetime.datetime(year+1, 1, separator_date)
-            wage = wage_calc(user, start_date, end_date)
-            bot.send_message(chat_id=update.message.chat_id,
-                             text=f"Wage in that period was {wage:.2f}")
-            return None
-    else:
-        now = datetime.datetime.now()
-        year = datetime.datetime.now().year
-        month = now.month if now.day > separator_date else now.month - 1
-        if month == 1:
-            start_date = datetime.datetime(year-1, 12, separator_date)
-            end_date = datetime.datetime(year, month, separator_date)
-        else:
-            start_date = datetime.datetime(year, month-1, separator_date)
-            end_date = datetime.datetime(year, month, separator_date)
+    if len(args) == 1 and not is_month(args[0]):
+        # wage by month
+        year = int(args[0])
+        acc = [int(x) for x in monthly_wages(user, year)]
+        bot.send_message(chat_id=update.message.chat_id, text=acc)
 
-    wage = wage_calc(user, start_date, end_date)
+    wage = wage_calc(user, *window)
 
     if wage is not None:
         bot.send_message(chat_id=update.message.chat_id,
@@ -518,14 +646,15 @@ def wage_admingrequest(bot, update, args):
 
 def modify_ignore(bot, update, args):
     """ /modignore add|remove CARD """
+    ignored = show_ignored_cards(update.message.chat_id)
     if len(args) != 2 or not valid_card(args[1]):
         bot.send_message(chat_id=update.message.chat_id,
                          text="Incorrect format")
-        if show_ignored_cards(update.message.chat_id):
+        if ignored:
             bot.send_message(chat_id=update.message.chat_id,
                     text="Ignored cards are:")
             bot.send_message(chat_id=update.message.chat_id,
-                    text=show_ignored_cards(update.message.chat_id))
+                    text=', '.join(sorted(ignored)))
             return None
         else:
             bot.send_message(chat_id=update.message.chat_id,
@@ -533,7 +662,7 @@ def modify_ignore(bot, update, args):
             return None
 
     if args[0] == "add":
-        if args[1] in show_ignored_cards(update.message.chat_id):
+        if args[1] in ignored:
             bot.send_message(chat_id=update.message.chat_id,
                 text=f"Card {args[1]} already in the list.")
             return None
@@ -541,7 +670,7 @@ def modify_ignore(bot, update, args):
             text=f"Adding {args[1]} to the list of ignored cards.")
         insert_ignored_card(update.message.chat_id, args[1])
     elif args[0] == "remove":
-        if args[1] not in show_ignored_cards(update.message.chat_id):
+        if args[1] not in ignored:
             bot.send_message(chat_id=update.message.chat_id,
                 text=f"Card {args[1]} not in the list.")
             return None
@@ -555,65 +684,70 @@ def modify_ignore(bot, update, args):
 
 def modify_notify(bot, update, args):
     """ /modnotify add|remove notified(username or chat_id) """
-    names = []
+    notified = sorted(to_notify(update.message.chat_id))
     if len(args) != 2:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Incorrect format")
-        if to_notify(update.message.chat_id):
+        if notified:
             bot.send_message(chat_id=update.message.chat_id,
                     text="chat_id's of the notified are:")
             bot.send_message(chat_id=update.message.chat_id,
-                    text=to_notify(update.message.chat_id))
-
-            for id_ in to_notify(update.message.chat_id):
-                names.append(name_from_chatid(id_))
-
+                    text=', '.join(str(id_) for id_ in notified))
             bot.send_message(chat_id=update.message.chat_id,
                     text="Usernames are:")
             bot.send_message(chat_id=update.message.chat_id,
-                    text=names)
+                    text=', '.join(str(name_from_chatid(id_))
+                                   for id_ in notified))
             return None
         else:
             bot.send_message(chat_id=update.message.chat_id,
                     text="Notify list is empty for this user.")
             return None
 
-    if args[0] == "add":
+    if args[0] not in ("add", "remove"):
         bot.send_message(chat_id=update.message.chat_id,
-                         text=f"Adding {args[1]} to the list of notified.")
-        if args[1].isdigit():
-            insert_notify(update.message.chat_id, args[1])
-        elif chatid_from_name(args[1]):
-            insert_notify(update.message.chat_id, chatid_from_name(args[1]))
-        else:
-            bot.send_message(chat_id=update.message.chat_id,
-                             text=f"User {args[1]} not found in the database")
-            bot.send_message(chat_id=update.message.chat_id,
-                             text=to_notify(update.message.chat_id))
+                         text="Incorrect format")
+        return None
 
-    elif args[0] == "remove":
-        if args[1] not in to_notify(update.message.chat_id):
+    target = int(args[1]) if args[1].isdigit() else chatid_from_name(args[1])
+    if target is None:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text=f"User {args[1]} not found in the database")
+        return None
+
+    if args[0] == "add":
+        insert_notify(update.message.chat_id, target)
+        bot.send_message(chat_id=update.message.chat_id,
+                         text=f"Added {args[1]} to the list of notified.")
+    else:
+        if target not in notified:
             bot.send_message(chat_id=update.message.chat_id,
                              text=f"User {args[1]} not in the list of notified")
             return None
-
+        remove_notify(update.message.chat_id, target)
         bot.send_message(chat_id=update.message.chat_id,
-                         text=f"Removing {args[1]} from the list of notified.")
-        if args[1].isdigit():
-            remove_notify(update.message.chat_id, args[1])
-            bot.send_message(chat_id=update.message.chat_id,
-                             text="Successfuly removed {args[1]}!")
-        elif chatid_from_name(args[1]):
-            remove_notify(update.message.chat_id, chatid_from_name(args[1]))
-            bot.send_message(chat_id=update.message.chat_id,
-                             text="Successfuly removed {args[1]}!")
-        else:
-            bot.send_message(chat_id=update.message.chat_id,
-                             text=f"User {args[1]} not found in the database")
+                         text=f"Successfuly removed {args[1]}!")
 
-    else:
+
+def user_data(bot, update):
+    """
+    /userdata - sends all records of a current user, as a text file if they
+    do not fit into a single message
+    """
+    records = io.StringIO()
+    for row in fetch_user_data(update.message.chat_id):
+        records.write(f"{row}\n")
+
+    if records.tell() == 0:
         bot.send_message(chat_id=update.message.chat_id,
-                         text="Incorrect format")
+                         text="No records for this user in database.")
+    elif records.tell() <= MAX_MESSAGE_LENGTH:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text=records.getvalue())
+    else:
+        bot.send_document(chat_id=update.message.chat_id,
+                          filename="userdata.txt",
+                          document=io.BytesIO(records.getvalue().encode()))
 
 
 def user_info(bot, update):
@@ -678,7 +812,7 @@ def main():
     modifynotify_handler = CommandHandler('modnotify', modify_notify,
                                           pass_args=True)
     formcsv_handler = CommandHandler('formcsv', form_csv)
-    sms_handler = MessageHandler(Filters.text, sms)
+    sms_handler = MessageHandler(Filters.text, add_sms)
     csv_handler = MessageHandler(Filters.document, csv_parse)
     purgedbcommence_handler = CallbackQueryHandler(purgedb_commence,
                                                    pattern='DROPDB')
@@ -712,16 +846,14 @@ def main():
 
 
 if __name__ == '__main__':
-    with sqlite3.connect(db_path, check_same_thread=False) as db:
-        cursor = db.cursor()
+    db = db_connect(db_path)
     print("Database initialized!")
     datatable_init()
     main()
 else:
     # Don't mess with main DB if imported as a module
     db_path = os.path.join(BASE_DIR, "test.db")
-    with sqlite3.connect(db_path, check_same_thread=False) as db:
-        cursor = db.cursor()
+    db = db_connect(db_path)
     datatable_init()
 
 
@@ -11,23 +11,106 @@ class ParseTest(unittest.TestCase):
 
         sms = "VISA1234 21.12.16 22:12 зачисление зарплаты 12345.57р Баланс: 16063.28р"
 
-        self.assertEqual('VISA1234', main.parse_sms(sms)['card'])
-        self.assertEqual(datetime.datetime(2016,12,21,22,12), main.parse_sms(sms)['datetime'])
-        self.assertEqual(12345.57, main.parse_sms(sms)['amount'])
+        result = main.parse_sms(sms)
+        self.assertEqual('VISA1234', result.card)
+        self.assertEqual(datetime.datetime(2016,12,21,22,12), result.datetime)
+        self.assertEqual(12345.57, result.amount)
 
 
     def test_failed_parse(self):
-        ''' parse_sms should fail with AttributeError on bad input'''
+        ''' parse_sms should return None on bad input'''
         sms = 'dasfdsf'
-        self.assertRaises(AttributeError, main.parse_sms, sms)
+        self.assertIsNone(main.parse_sms(sms))
+
+
+class WindowTest(unittest.TestCase):
+
+    def test_month_window_wraps_year(self):
+        ''' month_window should cross year boundary for January and month 0 '''
+        self.assertEqual((datetime.datetime(2016,12,15), datetime.datetime(2017,1,15)),
+                         main.month_window(2017, 1, 15))
+        self.assertEqual((datetime.datetime(2016,11,15), datetime.datetime(2016,12,15)),
+                         main.month_window(2017, 0, 15))
+
+    def test_period_window(self):
+        ''' period_window should resolve /wage arguments or return None '''
+        now = datetime.datetime(2017,6,20)
+        sep = main.separator_date
+        self.assertEqual(main.month_window(2017, 6, sep), main.period_window([], now))
+        self.assertEqual(main.month_window(2016, 3, sep),
+                         main.period_window(['03', '2016'], now))
+        self.assertEqual((main.month_window(2016, 1, sep)[0], main.month_window(2016, 12, sep)[1]),
+                         main.period_window(['2016'], now))
+        self.assertIsNone(main.period_window(['foo'], now))
+        self.assertIsNone(main.period_window(['13'], now))
 
 
 class DBTest(unittest.TestCase):
 
+    def test_lookup_unknown_user(self):
+        ''' name <-> chat_id lookups should return None for unknown users '''
+        self.assertIsNone(main.chatid_from_name('nosuchuser'))
+        self.assertIsNone(main.name_from_chatid(-1))
+
+    def test_migrate_text_dates(self):
+        ''' datatable_init should convert text dates of old databases '''
+        old_db = main.db_connect(':memory:')
+        old_db.execute('''CREATE TABLE data (
+                       chat_id INTEGER,
+                       name TEXT,
+                       card TEXT,
+                       date_time DATETIME,
+                       amount REAL,
+                       UNIQUE(chat_id, name, card, date_time, amount)
+                       )''')
+        old_db.executemany("INSERT INTO data VALUES (?, ?, ?, ?, ?)", [
+            (-3, 'test', 'VISA1234', datetime.datetime(2016,12,21,22,12), 10.0),
+            (-3, 'test', 'VISA1234', datetime.datetime(2017,1,10,9,30), 20.0)])
+        old_db.commit()
+        before = old_db.execute("SELECT * FROM data ORDER BY date_time").fetchall()
+        self.addCleanup(setattr, main, 'db', main.db)
+        self.addCleanup(old_db.close)
+        main.db = old_db
+
+        main.datatable_init()
+
+        self.assertEqual([('integer',), ('integer',)],
+                         old_db.execute("SELECT typeof(date_time) FROM data").fetchall())
+        self.assertEqual(before, sorted(main.fetch_user_data(-3),
+                                        key=lambda row: row[3]))
+        self.assertEqual(30.0, main.wage_calc(-3, datetime.datetime(2016,12,1),
+                                              datetime.datetime(2017,2,1)))
+        self.assertEqual(10.0, main.wage_calc(-3, datetime.datetime(2016,12,1),
+                                              datetime.datetime(2017,1,1)))
+
+    def test_monthly_wages(self):
+        ''' monthly_wages should match wage_calc over each month_window '''
+        sep = main.separator_date
+        self.addCleanup(main.purge_user, -2)
+        main.insert_transactions(-2, 'test', [
+            main.Sms('VISA1234', datetime.datetime(2016,12,sep,12), 10.0),
+            main.Sms('VISA1234', datetime.datetime(2017,5,sep-1,12), 20.0),
+            # exactly at separator midnight, still closes May's period
+            main.Sms('VISA1234', datetime.datetime(2017,5,sep,0,0), 40.0)])
+        expected = [main.wage_calc(-2, *main.month_window(2017, month, sep))
+                    for month in range(1, 13)]
+        wages = main.monthly_wages(-2, 2017)
+        self.assertEqual(expected, wages)
+        self.assertEqual(60.0, wages[4])
+        self.assertEqual(70.0, sum(wages))
+
     def test_read(self):
+        ''' table_data should yield 5-tuples with dates rendered as text '''
         main.datatable_init()
-        print(main.table_data())
-        main.db.close()
+        self.addCleanup(main.db.close)
+        main.insert_transactions(-4, 'test', [
+            main.Sms('VISA1234', datetime.datetime(2016,12,21,22,12), 10.0)])
+        self.addCleanup(main.purge_user, -4)
+        rows = list(main.table_data())
+        self.assertIn((-4, 'test', 'VISA1234', '2016-12-21 22:12:00', 10.0), rows)
+        for row in rows:
+            self.assertEqual(5, len(row))
+            self.assertIsInstance(row[3], str)
 
 if __name__ == '__main__':
     unittest.main()